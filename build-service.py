@@ -7,12 +7,12 @@ Usage:
     build-service [-v | -vv] <repo-url> [--branch=<branch>]
                   [--deploy-conf=<path/to/deploy.yml>] [--service-conf=<path/to/service.yml>]
                   [--restart=<image_name> | --delete=<image_name>]
-    build-service [-v | -vv] --daemon [--port=<port>]
+    build-service [-v | -vv] --daemon [--port=<port>] [--threads=<threads>] [--dev]
 
 CLI Options:
     -h --help               Show this help message
     -v --verbose            Show verbose/debug output. More v's for more verbosity.
-    -b --branch=BRANCH      Branch/tag to checkout repo to [default: main]
+    -b --branch=BRANCH      Branch/tag/commit to checkout repo to [default: main]
     -c --deploy-conf=FILE   Path to config file in repo, if not at /kaas.deploy.yml
     -s --service-conf=FILE  Path to config file in repo, if not at /kaas.service.yml
     -r --restart=NAME       Restart kubernetes deployment
@@ -21,28 +21,177 @@ CLI Options:
 Daemon Options:
     -d --daemon             Run in the background and listen for connections
     -p --port=PORT          Port to listen for connections on [default: 8800]
+    -t --threads=THREADS    Number of requests to handle at once [default: 16]
+    --dev                   Serve with Flask's development server instead of gunicorn
 """
 
+import base64
+import collections
+import copy
+import contextlib
+import functools
+import hashlib
 import logging
+import os
 import platform
 import re
+import shlex
+import shutil
+import subprocess
+import tarfile
 import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import docker
-import git
+import gunicorn.app.base
 import kubernetes
+import orjson
 import yaml
 from docopt import docopt
 from flask import Flask, request
+from flask.json.provider import JSONProvider
 from kubernetes.client.rest import ApiException
 
 
-from kubernetes import config, dynamic
-from kubernetes.client import api_client
+from kubernetes import dynamic
+
+
+class OrjsonProvider(JSONProvider):
+    # orjson parses and serializes request and response bodies faster than the stdlib
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# requests only carry repo details and configs, reject anything bigger early
+MAX_REQUEST_SIZE = 64 * 1024
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_SIZE
 dclient = docker.from_env()
 
+# shared pool for overlapping blocking io within a request
+executor = ThreadPoolExecutor(max_workers=4)
+# background builds started from POST /build, by job id
+build_executor = ThreadPoolExecutor(max_workers=4)
+jobs = {}
+# running build of each repo, commit, and configs, so identical jobs can share it
+_build_jobs = {}
+_jobs_lock = threading.Lock()
+
+# use libyaml-backed safe loader if available
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+# yaml .nan and .inf floats, which json can't represent
+_NON_FINITE_RE = re.compile(rb"\.(?:nan|inf)\b", re.IGNORECASE)
+# bytes to read config files in
+CONFIG_READ_SIZE = 1024 * 1024
+
+# platform.machine() arch string doesn't match docker's arch string
+_ARCH_MAP = {"x86": "386", "x86_64": "amd64", "armv7l": "arm", "aarch64": "arm64"}
+PLATFORM_STR = f"{platform.system()}/{_ARCH_MAP.get(platform.machine(), platform.machine())}".lower()
+
+# image and stage name of a Dockerfile FROM line, skipping flags like --platform
+_FROM_RE = re.compile(r"\s*FROM\s+(?:--\S+\s+)*(\S+)(?:\s+AS\s+(\S+))?", re.IGNORECASE)
+# ARG instruction and its declarations
+_ARG_RE = re.compile(r"\s*ARG\s+(.*)", re.IGNORECASE)
+# heredoc in a Dockerfile instruction, and its delimiter
+_HEREDOC_RE = re.compile(r"(?<!<)<<(?!<)-?\s*([\"']?)([A-Za-z_]\w*)\1")
+# instructions that can take heredocs
+_HEREDOC_INSTRUCTIONS = {"RUN", "COPY", "ADD"}
+# $VAR or ${VAR} reference in a Dockerfile instruction
+_VAR_RE = re.compile(r"\$(?:\{(\w+)\}|(\w+))")
+# scheme and empty credentials of a repo url, longest first
+_GIT_URL_PREFIXES = ("https://:@", "http://:@", "https://", "http://")
+# git clone error for a branch or tag that doesn't exist
+_MISSING_BRANCH_RE = re.compile(r"Remote branch .* not found")
+# git fetch error for a ref or commit that doesn't exist
+_MISSING_REF_RE = re.compile(r"couldn't find remote ref|not our ref")
+# public repo on a host that serves tarballs of a ref
+_ARCHIVE_HOST_RE = re.compile(
+    r"^https?://(?::@)?(?P<host>github\.com|gitlab\.com)/(?P<path>[^?#]+?)(?:\.git)?/?$"
+)
+# git attributes that make an archive differ from a checkout
+_EXPORT_ATTR_RE = re.compile(r"\bexport-(?:ignore|subst)\b")
+# full commit hash, sha1 or sha256
+_COMMIT_RE = re.compile(r"[0-9a-f]{40}|[0-9a-f]{64}")
+
+# field manager recorded for server-side applied objects
+FIELD_MANAGER = "build-service"
+
+# directory for a persistent local build cache, needs a buildx builder that
+# supports cache export (i.e. not the default docker driver)
+BUILD_CACHE_DIR = os.environ.get("KAAS_BUILD_CACHE_DIR")
+
+# directory for persistent per-repo checkouts that are updated in place instead
+# of cloning each build
+REPO_CACHE_DIR = os.environ.get("KAAS_REPO_CACHE_DIR")
+# lock and number of builds using it, for each persistent checkout in use
+_repo_locks = {}
+_repo_locks_lock = threading.Lock()
+
+# fetch github and gitlab repos as a tarball instead of cloning them if
+# KAAS_FETCH_ARCHIVES=1, needs a python with tarfile extraction filters
+FETCH_ARCHIVES = os.environ.get("KAAS_FETCH_ARCHIVES", "0") != "0"
+# seconds to wait on the archive download before falling back to cloning
+ARCHIVE_TIMEOUT = 30
+# seconds to wait on resolving a branch before building without sharing the build
+RESOLVE_TIMEOUT = 10
+
+# keys each request json must have
+_BUILD_KEYS = frozenset({"repo_url", "repo_branch", "deploy_config", "service_config"})
+_RESTART_KEYS = frozenset({"repo_url", "repo_branch", "deploy_config"})
+
+# seconds to keep finished build jobs for
+JOB_TTL = 60 * 60
+
+# directory to check out repos to, instead of picking one
+BUILD_TMPDIR = os.environ.get("KAAS_BUILD_TMPDIR")
+# tmpfs to check out repos to, if it has this many bytes free
+BUILD_TMPFS = "/dev/shm"
+BUILD_TMPFS_MIN_FREE = 2 * 1024**3
+
+# seconds to cache base image platforms from the registry for, and how many
+# images to cache them for
+REGISTRY_CACHE_TTL = 5 * 60
+REGISTRY_CACHE_SIZE = 256
+_registry_cache = {}
+
+# files checked out before the rest of the build context
+SPARSE_CHECKOUT_PATTERNS = [
+    "/Dockerfile",
+    "/.dockerignore",
+    "/kaas.*.yml",
+    "/kaas.*.json",
+]
+# deploy config annotation listing the sparse checkout patterns for the build context
+BUILD_CONTEXT_ANNOTATION = "kaas/build-context"
+
+
+class DaemonApplication(gunicorn.app.base.BaseApplication):
+    # serve the app with gunicorn, in one worker so build jobs and caches are
+    # shared, with threads to handle requests concurrently
+    def __init__(self, application, port, threads):
+        self.application = application
+        self.port = port
+        self.threads = threads
+        super().__init__()
+
+    def load_config(self):
+        self.cfg.set("bind", f"0.0.0.0:{self.port}")
+        self.cfg.set("workers", 1)
+        self.cfg.set("worker_class", "gthread")
+        self.cfg.set("threads", self.threads)
+
+    def load(self):
+        return self.application
+
 
 # custom exceptions
 class MissingConfigFile(FileNotFoundError):
@@ -56,7 +205,7 @@ class MissingConfigFile(FileNotFoundError):
         return f"{self.message}: {self.filename}"
 
 
-class BadGitRepo(git.exc.GitError):
+class BadGitRepo(Exception):
     def __init__(self, message="unable to clone repo"):
         self.message = message
 
@@ -64,7 +213,7 @@ class BadGitRepo(git.exc.GitError):
         return self.message
 
 
-class BadGitBranch(git.exc.GitError):
+class BadGitBranch(Exception):
     def __init__(self, branch, message="unable to checkout branch"):
         self.branch = branch
         self.message = message
@@ -93,33 +242,103 @@ class NameSpaceCreationFailed(kubernetes.client.exceptions.ApiException):
         return f"{self.message} '{self.namespace}'"
 
 
+class BadDeployConfig(Exception):
+    def __init__(
+        self,
+        message="deploy config has no image at spec.template.spec.containers[0].image",
+    ):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class BuildFailed(Exception):
+    def __init__(self, image, returncode, message="docker build failed"):
+        self.image = image
+        self.returncode = returncode
+        self.message = message
+
+    def __str__(self):
+        return f"{self.message} for '{self.image}' (exit code {self.returncode})"
+
+
 def load_config_file(filename):
     logging.info(f"reading config file from {filename}")
 
-    # load file
+    # load file, configs are small so one read without a buffered file object
+    # usually gets all of it
     try:
-        with open(filename, "r") as f:
-            config = yaml.load(f, Loader=yaml.Loader)
+        fd = os.open(filename, os.O_RDONLY)
     except FileNotFoundError:
         raise MissingConfigFile(filename) from FileNotFoundError
+    try:
+        chunks = [os.read(fd, CONFIG_READ_SIZE)]
+        while chunks[-1]:
+            chunks.append(os.read(fd, CONFIG_READ_SIZE))
+    finally:
+        os.close(fd)
+    data = b"".join(chunks)
+
+    # json is a subset of yaml, but much quicker to parse as json
+    if filename.endswith(".json"):
+        return orjson.loads(data)
+
+    encoded, config = _parse_config(data)
+    if encoded is None:
+        return copy.deepcopy(config)
+    return orjson.loads(encoded)
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_config(data):
+    # cached by file contents, as the same configs are built over and over. kept
+    # as json, which is much quicker to load than yaml, so callers get their own
+    # copy to modify
+    config = yaml.load(data, Loader=YAML_LOADER)
+    # orjson turns .nan and .inf into null, so keep those as parsed
+    if _NON_FINITE_RE.search(data) is None:
+        try:
+            return orjson.dumps(config), None
+        except orjson.JSONEncodeError:
+            pass
+    # not representable as json, callers copy it instead
+    return None, config
+
+
+def deploy_container(deploy_conf):
+    # container the repo's image is deployed to, checked up front so malformed
+    # configs fail before building rather than after
+    try:
+        container = deploy_conf["spec"]["template"]["spec"]["containers"][0]
+        valid = isinstance(container["image"], str)
+    except (KeyError, IndexError, TypeError):
+        valid = False
+    if not valid:
+        raise BadDeployConfig
 
-    return config
+    return container
+
+
+def default_config_file(kind, repo_dir):
+    # prefer json configs, e.g. when generated by a tool, as they're quicker to parse
+    if os.path.exists(f"{repo_dir}/kaas.{kind}.json"):
+        return f"kaas.{kind}.json"
+    return f"kaas.{kind}.yml"
 
 
 def get_deploy_conf(deploy_conf, repo_dir):
     # parse options from default config if none given
     if deploy_conf is None:
-        deploy_conf = "kaas.deploy.yml"
+        deploy_conf = default_config_file("deploy", repo_dir)
 
     if isinstance(deploy_conf, str):
         deploy_conf = load_config_file(f"{repo_dir}/{deploy_conf}")
 
     # make image build to localhost registry by modifying tag in config, if not present
-    image_name = deploy_conf["spec"]["template"]["spec"]["containers"][0]["image"]
-    if not image_name.startswith("localhost:5000/"):
-        deploy_conf["spec"]["template"]["spec"]["containers"][0]["image"] = (
-            "localhost:5000/" + image_name
-        )
+    container = deploy_container(deploy_conf)
+    if not container["image"].startswith("localhost:5000/"):
+        container["image"] = "localhost:5000/" + container["image"]
 
     return deploy_conf
 
@@ -127,7 +346,7 @@ def get_deploy_conf(deploy_conf, repo_dir):
 def get_service_conf(service_conf, repo_dir):
     # parse options from default config if none given
     if service_conf is None:
-        service_conf = "kaas.service.yml"
+        service_conf = default_config_file("service", repo_dir)
     if isinstance(service_conf, str):  # if string, its a filepath to load from
         return load_config_file(f"{repo_dir}/{service_conf}")
     else:
@@ -135,24 +354,364 @@ def get_service_conf(service_conf, repo_dir):
         return service_conf
 
 
-def clone_repo(repo, branch, repo_dir):
-    logging.info(f"cloning repo {repo} to {branch}")
+def strip_git_url(repo):
+    # repo url without its scheme and empty credentials, if it's an http(s) url
+    for prefix in _GIT_URL_PREFIXES:
+        if repo.startswith(prefix):
+            return repo.removeprefix(prefix)
+    return repo
+
 
+def git_url(repo):
     # add empty creds to clone url
     # git asks for auth if repo isnt public
     # we're only supporting public repos for now
-    repo = re.sub(r"^https?://(:@)?", "https://:@", repo)
+    if repo.startswith(_GIT_URL_PREFIXES):
+        return "https://:@" + strip_git_url(repo)
+    return repo
 
+
+def resolve_commit(repo, branch):
+    # commit a branch or tag points to, or None if it can't be resolved
+    if branch is not None and _COMMIT_RE.fullmatch(branch):
+        return branch
+
+    # ls-remote matches refs by their tail, so ask for exact refs and pick the
+    # one clone would, preferring a branch over a tag's commit
+    refs = ["HEAD"]
+    if branch is not None:
+        refs = [
+            f"refs/heads/{branch}",
+            f"refs/tags/{branch}^{{}}",
+            f"refs/tags/{branch}",
+        ]
+    try:
+        result = run_git(
+            "ls-remote", "--", git_url(repo), *refs, timeout=RESOLVE_TIMEOUT
+        )
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return None
+    commits = {}
+    for line in result.stdout.splitlines():
+        commit, _, ref = line.partition("\t")
+        commits[ref] = commit
+    for ref in refs:
+        if ref in commits:
+            return commits[ref]
+    return None
+
+
+def repo_tempdir():
+    if BUILD_TMPDIR is not None:
+        os.makedirs(BUILD_TMPDIR, exist_ok=True)
+        return tempfile.TemporaryDirectory(prefix="kaas-repo-build-", dir=BUILD_TMPDIR)
+
+    # check out to ram when there's room, so clones and build context reads skip the disk
+    tmpdir = None
     try:
-        repo = git.Repo.clone_from(repo, repo_dir)
-    except git.exc.GitCommandError:
+        if shutil.disk_usage(BUILD_TMPFS).free >= BUILD_TMPFS_MIN_FREE:
+            tmpdir = BUILD_TMPFS
+    except FileNotFoundError:
+        pass
+
+    return tempfile.TemporaryDirectory(prefix="kaas-repo-build-", dir=tmpdir)
+
+
+@contextlib.contextmanager
+def repo_workdir(repo):
+    if REPO_CACHE_DIR is None:
+        with repo_tempdir() as repo_dir:
+            yield repo_dir
+        return
+
+    # builds of the same repo share its checkout, so take turns
+    key = hashlib.sha1(strip_git_url(repo).encode()).hexdigest()
+    with _repo_locks_lock:
+        lock, users = _repo_locks.get(key, (None, 0))
+        lock = lock or threading.Lock()
+        _repo_locks[key] = (lock, users + 1)
+    try:
+        with lock:
+            repo_dir = f"{REPO_CACHE_DIR}/{key}"
+            # start over if a previous clone didn't finish
+            if not os.path.isdir(f"{repo_dir}/.git"):
+                shutil.rmtree(repo_dir, ignore_errors=True)
+                os.makedirs(repo_dir)
+            yield repo_dir
+    finally:
+        # drop the lock once nobody is using the checkout
+        with _repo_locks_lock:
+            lock, users = _repo_locks[key]
+            if users > 1:
+                _repo_locks[key] = (lock, users - 1)
+            else:
+                del _repo_locks[key]
+
+
+def run_git(*args, cwd=None, timeout=None):
+    logging.debug(f"running git {' '.join(args)}")
+    return subprocess.run(
+        ["git", *args],
+        cwd=cwd,
+        # fail instead of waiting on a prompt nobody will answer
+        env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},
+        timeout=timeout,
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+
+def archive_url(repo, branch):
+    # tarball of the repo at branch, or None if the host doesn't serve them
+    match = _ARCHIVE_HOST_RE.match(repo)
+    if match is None:
+        return None
+
+    host, path = match.group("host", "path")
+    ref = urllib.parse.quote(branch or "HEAD", safe="/")
+    if host == "github.com":
+        return f"https://github.com/{path}/archive/{ref}.tar.gz"
+    name = path.rsplit("/", 1)[-1]
+    return f"https://gitlab.com/{path}/-/archive/{ref}/{name}.tar.gz"
+
+
+def fetch_archive(url, repo_dir):
+    # returns whether the extracted tree matches a checkout
+    logging.info(f"fetching archive {url}")
+    attributes = []
+    with urllib.request.urlopen(url, timeout=ARCHIVE_TIMEOUT) as resp:
+        # stream mode extracts members as they're downloaded, without seeking
+        with tarfile.open(fileobj=resp, mode="r|gz") as tar:
+            for member in tar:
+                # strip the "<repo>-<ref>/" directory the whole tree is under
+                _, _, member.name = member.name.partition("/")
+                if member.name:
+                    tar.extract(member, repo_dir, filter="data")
+                if os.path.basename(member.name) == ".gitattributes":
+                    attributes.append(member.name)
+
+    # archives leave out export-ignore paths and rewrite export-subst files
+    for path in attributes:
+        with open(f"{repo_dir}/{path}", "r") as f:
+            if _EXPORT_ATTR_RE.search(f.read()):
+                logging.info(f"{path} sets export attributes")
+                return False
+    return True
+
+
+def update_repo(branch, repo_dir, config_paths=()):
+    logging.info(f"updating repo in {repo_dir} to {branch}")
+
+    # the previous build's files, blobs, and sparse checkout are reused, so
+    # only what changed is downloaded and written
+    try:
+        run_git("fetch", "--depth=1", "origin", branch or "HEAD", cwd=repo_dir)
+    except subprocess.CalledProcessError as e:
+        if branch is not None and _MISSING_REF_RE.search(e.stderr):
+            raise BadGitBranch(branch)
         raise BadGitRepo
+    run_git("reset", "--hard", "FETCH_HEAD", cwd=repo_dir)
+    run_git("clean", "-ffdx", cwd=repo_dir)
 
-    if branch is not None:
+    patterns = SPARSE_CHECKOUT_PATTERNS + [f"/{path}" for path in config_paths]
+    try:
+        run_git("sparse-checkout", "add", *patterns, cwd=repo_dir)
+    except subprocess.CalledProcessError:
+        # the previous build checked out the full repo
+        pass
+
+
+def clone_repo(repo, branch, repo_dir, config_paths=()):
+    if os.path.isdir(f"{repo_dir}/.git"):
+        return update_repo(branch, repo_dir, config_paths)
+
+    # persistent checkouts are always cloned, so they can be updated in place
+    use_archive = (
+        FETCH_ARCHIVES and REPO_CACHE_DIR is None and hasattr(tarfile, "data_filter")
+    )
+    url = archive_url(repo, branch) if use_archive else None
+    if url is not None:
         try:
-            repo.git.checkout(branch)
-        except git.exc.GitCommandError:
+            if fetch_archive(url, repo_dir):
+                return
+            logging.info("archive differs from a checkout, cloning instead")
+        except (OSError, tarfile.TarError) as e:
+            # missing repos and refs 404 too, the clone below reports those
+            logging.warning(f"fetching archive failed, cloning instead: {e}")
+        shutil.rmtree(repo_dir)
+        os.mkdir(repo_dir)
+
+    logging.info(f"cloning repo {repo} to {branch}")
+
+    repo = git_url(repo)
+
+    # only fetch the tip of the requested branch, we never need the history.
+    # file contents are fetched on checkout, so only the checked out paths are
+    # downloaded
+    clone_args = ["--depth=1", "--no-checkout", "--filter=blob:none"]
+    branch_args = [] if branch is None else ["--single-branch", "--branch", branch]
+    commit = None
+    try:
+        run_git("clone", *clone_args, *branch_args, "--", repo, repo_dir)
+    except subprocess.CalledProcessError as e:
+        if branch is None or not _MISSING_BRANCH_RE.search(e.stderr):
+            raise BadGitRepo
+        if not _COMMIT_RE.fullmatch(branch):
+            raise BadGitBranch(branch)
+
+        # --branch only takes branches and tags, fetch commits separately
+        try:
+            run_git("clone", *clone_args, "--", repo, repo_dir)
+        except subprocess.CalledProcessError:
+            raise BadGitRepo
+        try:
+            run_git("fetch", "--depth=1", "origin", branch, cwd=repo_dir)
+        except subprocess.CalledProcessError:
             raise BadGitBranch(branch)
+        commit = "FETCH_HEAD"
+
+    # only check out the Dockerfile and configs for now, the rest of the build
+    # context is checked out once the deploy config has been read
+    patterns = SPARSE_CHECKOUT_PATTERNS + [f"/{path}" for path in config_paths]
+    try:
+        run_git("sparse-checkout", "set", "--no-cone", *patterns, cwd=repo_dir)
+    except subprocess.CalledProcessError as e:
+        logging.warning(f"sparse checkout failed, checking out full repo: {e.stderr}")
+    run_git("checkout", *([commit] if commit else []), cwd=repo_dir)
+
+
+def is_sparse_checkout(repo_dir):
+    # archives and reused checkouts may already have the full repo
+    if not os.path.isdir(f"{repo_dir}/.git"):
+        return False
+    try:
+        result = run_git("config", "--type=bool", "core.sparseCheckout", cwd=repo_dir)
+    except subprocess.CalledProcessError:
+        return False
+    return result.stdout.strip() == "true"
+
+
+def checkout_build_context(repo_dir, deploy_conf):
+    if not is_sparse_checkout(repo_dir):
+        return
+
+    # sparse checkout is opt-in, as the build context may need any file in the repo
+    annotations = deploy_conf["metadata"].get("annotations") or {}
+    build_context = annotations.get(BUILD_CONTEXT_ANNOTATION, "").split()
+
+    if build_context:
+        logging.info(f"checking out build context {build_context}")
+        try:
+            run_git("sparse-checkout", "add", *build_context, cwd=repo_dir)
+            return
+        except subprocess.CalledProcessError as e:
+            logging.warning(
+                f"sparse checkout failed, checking out full repo: {e.stderr}"
+            )
+
+    logging.debug("checking out full repo")
+    run_git("sparse-checkout", "disable", cwd=repo_dir)
+
+
+def _registry_platforms(fromname):
+    # cache platforms per image, to skip the registry round trip on rebuilds
+    cached = _registry_cache.get(fromname)
+    if cached is not None and cached[0] > time.monotonic():
+        logging.debug(f"using cached platforms for {fromname}")
+        return cached[1]
+
+    fromdata = dclient.images.get_registry_data(fromname)
+    platforms = [f"{p['os']}/{p['architecture']}" for p in fromdata.attrs["Platforms"]]
+    # reinsert so the dict stays in lookup order, then drop the oldest lookups
+    _registry_cache.pop(fromname, None)
+    _registry_cache[fromname] = (time.monotonic() + REGISTRY_CACHE_TTL, platforms)
+    while len(_registry_cache) > REGISTRY_CACHE_SIZE:
+        _registry_cache.pop(next(iter(_registry_cache)), None)
+    return platforms
+
+
+def dockerfile_instructions(filename):
+    # instructions of a Dockerfile, with continuation lines joined and comments
+    # and heredoc bodies skipped
+    instruction = ""
+    heredocs = []
+    with open(filename, "r") as df:
+        for line in df:
+            line = line.strip()
+            if heredocs:
+                if line == heredocs[0]:
+                    heredocs.pop(0)
+                continue
+            if line.startswith("#"):
+                continue
+
+            words = (instruction or line).split(maxsplit=1)
+            if words and words[0].upper() in _HEREDOC_INSTRUCTIONS:
+                heredocs += [match.group(2) for match in _HEREDOC_RE.finditer(line)]
+            if line.endswith("\\"):
+                instruction += line[:-1] + " "
+                continue
+            instruction += line
+            if instruction:
+                yield instruction
+            instruction = ""
+
+    if instruction:
+        yield instruction
+
+
+def dockerfile_base_images(filename):
+    # base image of each build stage, skipping stages built from an earlier stage
+    images = []
+    stages = {"scratch"}
+    # ARGs declared before the first FROM can be used in FROM lines
+    args = {}
+    global_scope = True
+    for instruction in dockerfile_instructions(filename):
+        match = _FROM_RE.match(instruction)
+        if match is None:
+            arg_match = _ARG_RE.match(instruction)
+            if arg_match is not None and global_scope:
+                try:
+                    declarations = shlex.split(arg_match.group(1))
+                except ValueError:
+                    declarations = []
+                for declaration in declarations:
+                    name, sep, default = declaration.partition("=")
+                    if sep:
+                        args[name] = default
+            continue
+
+        global_scope = False
+        image, stage = match.groups()
+        image = _VAR_RE.sub(
+            lambda var: args.get(var.group(1) or var.group(2), var.group(0)), image
+        )
+        if "$" in image:
+            # set with --build-arg, or not at all, so there's nothing to look up
+            logging.debug(f"skipping base image {image} with unset build args")
+        elif image.lower() not in stages:
+            images.append(image)
+        if stage is not None:
+            stages.add(stage.lower())
+
+    return images
+
+
+def check_base_image(repo_dir):
+    # pull images before building to make sure they're supported
+    for fromname in dockerfile_base_images(f"{repo_dir}/Dockerfile"):
+        logging.info(f"pulling base image {fromname} to check architecture")
+
+        platforms = _registry_platforms(fromname)
+        if PLATFORM_STR not in platforms:
+            # drop cached platforms so a retry sees an updated manifest
+            _registry_cache.pop(fromname, None)
+            raise ArchNotSupported(fromname, PLATFORM_STR, platforms)
+
+        logging.info(f"base image {fromname} good, continuing build")
 
 
 def build_repo(repo_dir, branch, deploy_conf, service_conf):
@@ -160,40 +719,62 @@ def build_repo(repo_dir, branch, deploy_conf, service_conf):
     logging.debug(
         f"building repo '{repo_dir}@{branch}' with deploy conf '{deploy_conf}' and service conf '{service_conf}'"
     )
-    # pull image before building to make sure its supported
-    with open(f"{repo_dir}/Dockerfile", "r") as df:
-        fromregex = re.compile(r"^FROM (.+:?.+)", re.IGNORECASE | re.MULTILINE)
-        fromname = fromregex.search(df.read()).groups()[0]
-
-    logging.info(f"pulling base image {fromname} to check architecture")
-    # plat.machine() arch string doesn't match docker's arch string
-    platform_mappings = {
-        "python": "docker",
-        "x86": "386",
-        "x86_64": "amd64",
-        "armv7l": "arm",
-        "aarch64": "arm64",
-    }
-    platform_str = (
-        f"{platform.system()}/{platform_mappings[platform.machine()]}".lower()
+    image_name = deploy_container(deploy_conf)["image"]
+
+    # keep the clone's .git out of the build context
+    with open(f"{repo_dir}/.dockerignore", "a+") as di:
+        di.seek(0)
+        ignored = di.read()
+        if ignored and not ignored.endswith("\n"):
+            di.write("\n")
+        di.write(".git\n")
+
+    # build and push to local repository with buildx, docker-py's build API only
+    # supports the legacy builder. the image carries its layer cache inline, so
+    # later builds of it on any host can reuse unchanged layers
+    cache_args = ["--cache-from", f"type=registry,ref={image_name}"]
+    cache_args += ["--cache-to", "type=inline"]
+    if BUILD_CACHE_DIR is not None:
+        # also keep every stage's layers on disk, which survives daemon restarts
+        # and covers intermediate stages that the inline cache leaves out
+        cache_dir = os.path.join(BUILD_CACHE_DIR, re.sub(r"[/:@]", "_", image_name))
+        cache_args += ["--cache-from", f"type=local,src={cache_dir}"]
+        cache_args += ["--cache-to", f"type=local,dest={cache_dir},mode=max"]
+
+    logging.debug(f"building and pushing image to {image_name}")
+    build = subprocess.Popen(
+        ["docker", "buildx", "build", "--progress=plain", "--push"]
+        + cache_args
+        + ["--tag", image_name, repo_dir],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
     )
+    # stream build output as it comes, keeping the tail to report failures
+    output = collections.deque(maxlen=50)
+    for line in build.stdout:
+        logging.debug(line.rstrip())
+        output.append(line)
+    if build.wait() != 0:
+        logging.error("".join(output).rstrip())
+        raise BuildFailed(image_name, build.returncode)
 
-    fromdata = dclient.images.get_registry_data(fromname)
-    platforms = [f"{p['os']}/{p['architecture']}" for p in fromdata.attrs["Platforms"]]
-    if platform_str not in platforms:
-        raise ArchNotSupported(fromdata.image_name, platform_str, platforms)
+    # return label of build image
+    return image_name
 
-    logging.info(f"base image {fromname} good, continuing build")
 
-    image_name = deploy_conf["spec"]["template"]["spec"]["containers"][0]["image"]
-    dclient.images.build(path=repo_dir, tag=image_name)
+@functools.lru_cache(maxsize=None)
+def kubernetes_app_api():
+    # load kube config from ~/.kube/config on first use and share the api client,
+    # so --help and the daemon start without one
+    kubernetes.config.load_kube_config()
+    return kubernetes.client.AppsV1Api()
 
-    # push image to local repository
-    logging.debug(f"pushing image to {image_name}")
-    dclient.images.push(f"{image_name}")
 
-    # return label of build image
-    return image_name
+@functools.lru_cache(maxsize=None)
+def dynamic_client():
+    # created on first use, as it queries the api server for its resources
+    return dynamic.DynamicClient(kubernetes_app_api().api_client)
 
 
 # create a new namespace specified in the deployment script and the namespace is not already in the system.
@@ -215,10 +796,9 @@ def create_namespace(kubernetes_api, deploy_conf):
             logging.debug(f"deployments found for {ns}. Don't need to make namespace")
             raise NameSpaceCreationFailed(ns)
         else:
-            testclient = dynamic.DynamicClient(
-                api_client.ApiClient(configuration=config.load_kube_config())
+            namespace_api = dynamic_client().resources.get(
+                api_version="v1", kind="Namespace"
             )
-            namespace_api = testclient.resources.get(api_version="v1", kind="Namespace")
             namespace_manifest = {
                 "apiVersion": "v1",
                 "kind": "Namespace",
@@ -232,20 +812,79 @@ def create_namespace(kubernetes_api, deploy_conf):
         raise NameSpaceCreationFailed(ns)
 
 
+def _encode_config_value(value):
+    # yaml !!binary values, which kubernetes expects base64 encoded
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    raise TypeError(f"can't encode {type(value).__name__} in config")
+
+
+def apply_config(path, name, namespace, config):
+    # server-side apply creates or updates the object in one idempotent call
+    # json is valid yaml, and is sent as a string as the client can't encode
+    # dicts for the apply content type
+    dynamic_client().request(
+        "patch",
+        path,
+        path_params={"name": name, "namespace": namespace},
+        body=orjson.dumps(
+            config, default=_encode_config_value, option=orjson.OPT_NON_STR_KEYS
+        ).decode(),
+        content_type="application/apply-patch+yaml",
+        field_manager=FIELD_MANAGER,
+        force_conflicts=True,
+    )
+
+
+def apply_deployment(deploy_conf, name=None):
+    apply_config(
+        "/apis/apps/v1/namespaces/{namespace}/deployments/{name}",
+        name or deploy_conf["metadata"]["name"],
+        deploy_conf["metadata"]["namespace"],
+        deploy_conf,
+    )
+
+
+def apply_service(service_conf, namespace):
+    apply_config(
+        "/api/v1/namespaces/{namespace}/services/{name}",
+        service_conf["metadata"]["name"],
+        namespace,
+        service_conf,
+    )
+
+
+def deploy_configs(deploy_conf, service_conf):
+    # deployment and service are independent, so apply them concurrently
+    futures = [
+        executor.submit(apply_deployment, deploy_conf),
+        executor.submit(
+            apply_service, service_conf, deploy_conf["metadata"]["namespace"]
+        ),
+    ]
+    for future in futures:
+        future.result()
+
+
+@app.errorhandler(413)
+def request_too_large(e):
+    logging.error("request body too large")
+    return {"err": f"Bad request: body is over {MAX_REQUEST_SIZE} bytes"}, 413
+
+
 # POST /build: JSON API to start new build
 @app.route("/build", methods=["POST"])
 def build_request():
-    reqj = request.get_json()
+    reqj = request.get_json(silent=True)
     logging.debug(f"request: {reqj}")
 
-    if not (
-        "repo_url" in reqj
-        and "repo_branch" in reqj
-        and "deploy_config" in reqj
-        and "service_config" in reqj
-    ):
-        logging.error("missing keys")
-        return {"err": "Bad request: missing keys"}, 400
+    if not isinstance(reqj, dict):
+        logging.error("request body isn't a json object")
+        return {"err": "Bad request: expected a JSON object"}, 400
+    if not _BUILD_KEYS <= reqj.keys():
+        missing = sorted(_BUILD_KEYS - reqj.keys())
+        logging.error(f"missing keys {missing}")
+        return {"err": f"Bad request: missing keys {missing}"}, 400
 
     # accepts json as string or as part of request json
     try:
@@ -255,42 +894,141 @@ def build_request():
         logging.error("malformed config payload")
         return {"err": "Bad request: malformed config payload"}, 400
 
-    with tempfile.TemporaryDirectory(prefix="kaas-repo-build-") as repo_dir:
-        clone_repo(reqj["repo_url"], reqj["repo_branch"], repo_dir)
-        deploy_conf = get_deploy_conf(deploy_conf_location, repo_dir)
-        service_conf = get_service_conf(service_conf_location, repo_dir)
+    # configs sent with the request can be checked before starting the build
+    if isinstance(deploy_conf_location, dict):
+        try:
+            deploy_container(deploy_conf_location)
+        except BadDeployConfig as e:
+            logging.error(f"bad deploy config: {e}")
+            return {"err": f"Bad request: {e}"}, 400
+
+    try:
+        configs = orjson.dumps(
+            (deploy_conf_location, service_conf_location), option=orjson.OPT_SORT_KEYS
+        )
+    except orjson.JSONEncodeError:
+        # nested too deeply to encode
+        logging.error("malformed config payload")
+        return {"err": "Bad request: malformed config payload"}, 400
+    if not isinstance(reqj["repo_url"], str) or not isinstance(
+        reqj["repo_branch"], (str, type(None))
+    ):
+        logging.error("malformed repo url or branch")
+        return {"err": "Bad request: malformed repo url or branch"}, 400
+
+    with _jobs_lock:
+        # builds take minutes, so run them in the background and let the client poll
+        job_id = uuid.uuid4().hex
+        job = build_executor.submit(
+            build_job,
+            reqj["repo_url"],
+            reqj["repo_branch"],
+            deploy_conf_location,
+            service_conf_location,
+            configs,
+        )
+
+        # forget finished jobs nobody has asked about in a while
+        now = time.monotonic()
+        for old_id, (created, old_job) in list(jobs.items()):
+            if old_job.done() and created + JOB_TTL < now:
+                del jobs[old_id]
+        jobs[job_id] = (now, job)
+
+    logging.info(f"started build job {job_id}")
+    return {"job": job_id}, 202
+
+
+# GET /build/<job_id>: JSON API to check on a build started with POST /build
+@app.route("/build/<job_id>", methods=["GET"])
+def build_status_request(job_id):
+    if job_id not in jobs:
+        return {"err": f"Unknown job '{job_id}'"}, 404
+
+    _, job = jobs[job_id]
+    if not job.done():
+        return {"status": "running"}, 202
+
+    try:
+        return job.result()
+    except Exception as e:
+        logging.error(f"failed to build: {e}")
+        return {"err": f"Failed to build: {e}"}, 500
+
+
+def build_job(
+    repo_url, repo_branch, deploy_conf_location, service_conf_location, configs
+):
+    # identical requests for the same commit share one build, so retries and
+    # duplicate webhooks don't race to push the same image
+    commit = resolve_commit(repo_url, repo_branch)
+    if commit is None:
+        return run_build(
+            repo_url, repo_branch, deploy_conf_location, service_conf_location
+        )
+
+    build_key = (repo_url, commit, configs)
+    with _jobs_lock:
+        build = _build_jobs.get(build_key)
+        shared = build is not None
+        if not shared:
+            build = _build_jobs[build_key] = Future()
+    if shared:
+        logging.info(f"waiting on the running build of {repo_url}@{commit}")
+        return build.result()
+
+    # build the commit the job is shared for, not whatever the branch points to
+    # once the build starts
+    try:
+        result = run_build(
+            repo_url, commit, deploy_conf_location, service_conf_location
+        )
+    except BaseException as e:
+        build.set_exception(e)
+        raise
+    else:
+        build.set_result(result)
+        return result
+    finally:
+        with _jobs_lock:
+            del _build_jobs[build_key]
+
+
+def run_build(repo_url, repo_branch, deploy_conf_location, service_conf_location):
+    with repo_workdir(repo_url) as repo_dir:
+        config_paths = [
+            c
+            for c in (deploy_conf_location, service_conf_location)
+            if isinstance(c, str)
+        ]
+        clone_repo(repo_url, repo_branch, repo_dir, config_paths)
+
+        # configs and the base image registry lookup are independent, so overlap them
+        base_image = executor.submit(check_base_image, repo_dir)
+        deploy_future = executor.submit(get_deploy_conf, deploy_conf_location, repo_dir)
+        service_future = executor.submit(
+            get_service_conf, service_conf_location, repo_dir
+        )
+        deploy_conf = deploy_future.result()
+        service_conf = service_future.result()
+        checkout_build_context(repo_dir, deploy_conf)
 
         try:
-            image_name = build_repo(
-                repo_dir, reqj["repo_branch"], deploy_conf, service_conf
-            )
+            base_image.result()
+            image_name = build_repo(repo_dir, repo_branch, deploy_conf, service_conf)
         except Exception as e:
             logging.error(f"failed to build: {e}")
             return {"err": f"Failed to build: {e}"}, 500
 
         logging.debug("deploying to k8s")
-        # load kube config from ~/.kube/config
-        kubernetes.config.load_kube_config()
-        kubernetes_app_api = kubernetes.client.AppsV1Api()
-        kubernetes_core_api = kubernetes.client.CoreV1Api()
 
         try:
-            create_namespace(kubernetes_app_api, deploy_conf)
+            create_namespace(kubernetes_app_api(), deploy_conf)
         except ApiException as e:
             logging.error(f"Error creating namespace: {e}")
             return {"err": f"Failed to deploy: {e}"}, 500
         try:
-            kubernetes_app_api.create_namespaced_deployment(
-                body=deploy_conf, namespace=deploy_conf["metadata"]["namespace"]
-            )
-        except ApiException as e:
-            logging.error(f"failed to deploy: {e}")
-            return {"err": f"Failed to deploy: {e}"}, 500
-
-        try:
-            kubernetes_core_api.create_namespaced_service(
-                body=service_conf, namespace=deploy_conf["metadata"]["namespace"]
-            )
+            deploy_configs(deploy_conf, service_conf)
         except ApiException as e:
             logging.error(f"failed to deploy: {e}")
             return {"err": f"Failed to deploy: {e}"}, 500
@@ -307,11 +1045,8 @@ def delete_request(image_name):
     logging.debug(f"request: {reqj}")
 
     logging.debug(f"deleting {image_name} from k8s")
-    # load kube config from ~/.kube/config
-    kubernetes.config.load_kube_config()
-    kubernetes_app_api = kubernetes.client.AppsV1Api()
     try:
-        kubernetes_app_api.delete_namespaced_deployment(
+        kubernetes_app_api().delete_namespaced_deployment(
             name=image_name, namespace=deploy_conf["metadata"]["namespace"]
         )
     except ApiException as e:
@@ -326,12 +1061,16 @@ def delete_request(image_name):
 # PATCH /build: JSON API to restart existing deployment
 @app.route("/build/<image_name>", methods=["PATCH"])
 def restart_request(image_name):
-    reqj = request.get_json()
+    reqj = request.get_json(silent=True)
     logging.debug(f"request: {reqj}")
 
-    if not ("repo_url" in reqj and "repo_branch" in reqj and "deploy_config" in reqj):
-        logging.error("missing keys")
-        return {"err": "Bad request: missing keys"}, 400
+    if not isinstance(reqj, dict):
+        logging.error("request body isn't a json object")
+        return {"err": "Bad request: expected a JSON object"}, 400
+    if not _RESTART_KEYS <= reqj.keys():
+        missing = sorted(_RESTART_KEYS - reqj.keys())
+        logging.error(f"missing keys {missing}")
+        return {"err": f"Bad request: missing keys {missing}"}, 400
 
     # accepts json as string or as part of request json
     try:
@@ -340,20 +1079,16 @@ def restart_request(image_name):
         logging.error("malformed config payload")
         return {"err": "Bad request: malformed config payload"}, 400
 
-    with tempfile.TemporaryDirectory(prefix="kaas-repo-build-") as repo_dir:
-        clone_repo(reqj["repo_url"], reqj["repo_branch"], repo_dir)
+    with repo_workdir(reqj["repo_url"]) as repo_dir:
+        config_paths = (
+            [deploy_conf_location] if isinstance(deploy_conf_location, str) else []
+        )
+        clone_repo(reqj["repo_url"], reqj["repo_branch"], repo_dir, config_paths)
         deploy_conf = get_deploy_conf(deploy_conf_location, repo_dir)
 
         logging.debug(f"restarting {image_name} in k8s")
-        # load kube config from ~/.kube/config
-        kubernetes.config.load_kube_config()
-        kubernetes_app_api = kubernetes.client.AppsV1Api()
         try:
-            kubernetes_app_api.patch_namespaced_deployment(
-                name=image_name,
-                namespace=deploy_conf["metadata"]["namespace"],
-                body=deploy_conf,
-            )
+            apply_deployment(deploy_conf, name=image_name)
         except ApiException as e:
             logging.error(f"failed to restart: {e}")
             return {"err": f"Failed to restart: {e}"}, 500
@@ -380,66 +1115,52 @@ if __name__ == "__main__":
 
     # run as daemon and listen for build requests on --port
     if args["--daemon"]:
-        app.run(host="0.0.0.0", port=args["--port"], debug=args["--verbose"])
+        if args["--dev"]:
+            app.run(host="0.0.0.0", port=args["--port"], debug=args["--verbose"])
+        else:
+            DaemonApplication(app, args["--port"], int(args["--threads"])).run()
         exit(0)
 
-    with tempfile.TemporaryDirectory(prefix="kaas-repo-build-") as repo_dir:
-        repo = args["<repo-url>"]
+    repo = args["<repo-url>"]
+    with repo_workdir(repo) as repo_dir:
         branch = args["--branch"]
-        clone_repo(repo, branch, repo_dir)
+        config_paths = [c for c in (args["--deploy-conf"], args["--service-conf"]) if c]
+        clone_repo(repo, branch, repo_dir, config_paths)
         deploy_conf = get_deploy_conf(args["--deploy-conf"], repo_dir)
         service_conf = get_service_conf(args["--service-conf"], repo_dir)
 
-        # load kube config from ~/.kube/config
-        kubernetes.config.load_kube_config()
-        kubernetes_app_api = kubernetes.client.AppsV1Api()
-        kubernetes_core_api = kubernetes.client.CoreV1Api()
-
         try:
             if args["--restart"]:
                 image_name = args["--restart"]
-                kubernetes_app_api.patch_namespaced_deployment(
-                    name=image_name,
-                    namespace=deploy_conf["metadata"]["namespace"],
-                    body=deploy_conf,
-                )
+                apply_deployment(deploy_conf, name=image_name)
                 logging.info(f"Successfully restarted '{image_name}'")
 
             elif args["--delete"]:
                 image_name = args["--delete"]
-                kubernetes_app_api.delete_namespaced_deployment(
+                kubernetes_app_api().delete_namespaced_deployment(
                     name=image_name, namespace=deploy_conf["metadata"]["namespace"]
                 )
                 logging.info(f"Successfully deleted '{image_name}'")
 
             else:
                 try:
+                    check_base_image(repo_dir)
+                    checkout_build_context(repo_dir, deploy_conf)
                     image_name = build_repo(repo_dir, branch, deploy_conf, service_conf)
                 except Exception as e:
                     logging.error(f"Error building repo: {e}")
                     exit(1)
 
                 try:
-                    create_namespace(kubernetes_app_api, deploy_conf)
+                    create_namespace(kubernetes_app_api(), deploy_conf)
                 except ApiException as e:
                     logging.error(f"Error creating namespace: {e}")
                     exit(1)
 
                 try:
-                    kubernetes_app_api.create_namespaced_deployment(
-                        body=deploy_conf, namespace=deploy_conf["metadata"]["namespace"]
-                    )
-                except ApiException as e:
-                    logging.error(f"Error creating deployment: {e}")
-                    exit(1)
-
-                try:
-                    kubernetes_core_api.create_namespaced_service(
-                        body=service_conf,
-                        namespace=deploy_conf["metadata"]["namespace"],
-                    )
+                    deploy_configs(deploy_conf, service_conf)
                 except ApiException as e:
-                    logging.error(f"Error creating service: {e}")
+                    logging.error(f"Error deploying repo: {e}")
                     exit(1)
 
                 logging.info(